@@ -141,16 +141,17 @@ class SkipIfAtLeastPyTorchVersion:
         )(obj)
 
 
-def make_nifti_image(array, affine=None):
+def make_nifti_image(array, affine=None, dir=None):
     """
     Create a temporary nifti image on the disk and return the image name.
+    The file is created in `dir` if given, otherwise in the default temporary directory.
     User is responsible for deleting the temporary file when done with it.
     """
     if affine is None:
         affine = np.eye(4)
     test_image = nib.Nifti1Image(array, affine)
 
-    temp_f, image_name = tempfile.mkstemp(suffix=".nii.gz")
+    temp_f, image_name = tempfile.mkstemp(suffix=".nii.gz", dir=dir)
     nib.save(test_image, image_name)
     os.close(temp_f)
     return image_name